@@ -5,30 +5,189 @@
 """
 
 import os
+import re
+import copy
+
+# CUDA內存分配策略必須在torch初始化CUDA之前設置；已在shell中設置時以用戶設置為準
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:128')
+
 import tempfile
+import shutil
 import logging
-from transformers import pipeline
+import functools
+import contextlib
+import subprocess
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
 import torch
 import soundfile as sf
 import numpy as np
 
+try:
+    from transformers import EncoderDecoderCache, StaticCache
+except ImportError:
+    EncoderDecoderCache = StaticCache = None
+
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+try:
+    import av
+except ImportError:
+    av = None
+
 # 配置日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 支持的音頻格式
+SUPPORTED_AUDIO_EXT = frozenset({'.wav', '.mp3', '.m4a', '.flac', '.ogg'})
+SUPPORTED_AUDIO_TUPLE = tuple(sorted(SUPPORTED_AUDIO_EXT))
+# 需要ffmpeg才能獲得最佳支持的格式
+FFMPEG_AUDIO_EXT = frozenset({'.mp3', '.m4a', '.ogg'})
+# ONNX導出及量化結果的磁盤緩存目錄
+ONNX_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'onnx')
+# 編譯後的模型只使用這些批大小（不足時補齊），啟動時逐一預熱
+COMPILED_BATCH_SIZES = (1, 2, 4, 8)
+
+def resample_audio(audio, orig_sr, target_sr=16000):
+    """重採樣：優先使用soxr（SIMD帶限重採樣），未安裝時使用torchaudio的Kaiser窗sinc插值"""
+    if soxr is not None:
+        return soxr.resample(np.ascontiguousarray(audio, dtype=np.float32), orig_sr, target_sr, quality='HQ')
+    
+    import torchaudio
+    waveform = torch.from_numpy(np.ascontiguousarray(audio, dtype=np.float32))
+    resampled = torchaudio.functional.resample(
+        waveform, int(orig_sr), int(target_sr),
+        resampling_method="sinc_interp_kaiser"
+    )
+    return resampled.numpy()
+
+def decode_audio_av(buffer):
+    """
+    使用PyAV在內存中解碼soundfile不支援的編碼（如mp3、m4a），需要安裝av
+    
+    Returns:
+        tuple: (float32單聲道音頻數組, 採樣率)
+    """
+    with av.open(buffer) as container:
+        stream = container.streams.audio[0]
+        sr = stream.codec_context.sample_rate
+        # 解碼時直接轉成packed float32單聲道
+        resampler = av.AudioResampler(format='flt', layout='mono', rate=sr)
+        chunks = []
+        for frame in container.decode(stream):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+    
+    if not chunks:
+        return np.zeros(0, dtype=np.float32), sr
+    return np.concatenate(chunks), sr
+
+@contextlib.contextmanager
+def temp_audio_file(buffer, suffix='.wav'):
+    """將文件對象中的音頻寫入臨時文件，離開時刪除，產出臨時文件路徑"""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+        try:
+            shutil.copyfileobj(buffer, temp_file, length=1024 * 1024)
+        except BaseException:
+            temp_file.close()
+            os.unlink(temp_file.name)
+            raise
+    try:
+        yield temp_file.name
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_file.name)
+
+@functools.lru_cache(maxsize=None)
+def find_ffmpeg():
+    """
+    查找可用的ffmpeg，結果在進程內緩存
+    
+    依次檢查系統PATH、本模組旁的ffmpeg_bin和當前目錄下的ffmpeg_bin
+    
+    Returns:
+        str: ffmpeg可執行文件路徑，未找到時返回None
+    """
+    candidates = [
+        ('ffmpeg', "找到系統PATH中的ffmpeg"),
+        (os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ffmpeg_bin', 'ffmpeg.exe'),
+         "找到本地ffmpeg_bin中的ffmpeg"),
+        (os.path.abspath(os.path.join('ffmpeg_bin', 'ffmpeg.exe')),
+         "找到當前目錄下的ffmpeg_bin中的ffmpeg"),
+    ]
+    
+    for ffmpeg_path, message in candidates:
+        if ffmpeg_path != 'ffmpeg' and not os.path.exists(ffmpeg_path):
+            continue
+        try:
+            result = subprocess.run([ffmpeg_path, '-version'],
+                                    capture_output=True, text=True, timeout=5)
+            if result.returncode == 0:
+                logger.info(message)
+                if ffmpeg_path != 'ffmpeg':
+                    # 將ffmpeg_bin路徑添加到環境變量（只在首次查找時執行一次）
+                    os.environ['PATH'] = os.path.dirname(ffmpeg_path) + os.pathsep + os.environ.get('PATH', '')
+                return ffmpeg_path
+        except Exception:
+            pass
+    
+    logger.warning("未找到ffmpeg，將使用替代方法處理音頻")
+    return None
+
 class LocalSTT:
     """本地台語語音辨識類"""
     
-    def __init__(self, model_path=None):
+    def __init__(self, model_path=None, backend="transformers", compile_model=True, cpu_int8=True,
+                 assistant_model_path=None, warmup_on_load=True):
         """
         初始化STT模型
         
         Args:
             model_path: 模型路徑，如果為None則使用Hugging Face模型
+            backend: 推理後端，"transformers"、"faster_whisper" 或 "onnx"
+                     (faster_whisper需要CTranslate2格式的模型；onnx僅用於CPU，需要optimum[onnxruntime]；
+                      不可用時均回退到transformers)
+            compile_model: 使用GPU時是否以torch.compile編譯encoder/decoder
+            cpu_int8: 使用CPU時是否對Linear層做動態int8量化
+            assistant_model_path: 推測解碼用的小型草稿模型路徑（需與主模型共用Whisper多語言詞表），
+                                  啟用後每次只能推理一個音頻
+            warmup_on_load: 是否在載入時預熱；為False時由調用方在執行推理的線程中調用warmup()
         """
         self.model = None
+        self.processor = None
         self.model_path = model_path
+        self.backend = backend
+        self.compile_model = compile_model
+        self.compiled = False
+        self.static_cache = False
+        self.cpu_int8 = cpu_int8
+        self.quantized = False
+        self._ffmpeg_ok = None
         self.device = None
+        self.torch_dtype = None
+        self.assistant_model_path = assistant_model_path
+        self.warmup_on_load = warmup_on_load
+        self._uncompiled_forwards = None
+        self._pinned_features = None
+        self._staging_done = None
+        # 按補齊後的批大小預分配的靜態KV緩存，在推理線程預熱時創建
+        self._static_caches = {}
+        # 貪婪解碼，不做溫度回退重試
+        self.generate_kwargs = {
+            "language": "zh",  # 中文
+            "task": "transcribe",
+            "num_beams": 1,
+            "temperature": 0.0,
+            "condition_on_prev_tokens": False
+        }
         self.load_model()
     
     def load_model(self):
@@ -45,6 +204,9 @@ class LocalSTT:
                 model_path = "NUTN-KWS/Whisper-Taiwanese-model-v0.5"
                 logger.info(f"使用Hugging Face模型: {model_path}")
             
+            # 只在載入時檢查一次ffmpeg，之後直接使用結果
+            self.check_ffmpeg()
+            
             # 優化GPU配置
             if torch.cuda.is_available():
                 # 檢查GPU內存
@@ -52,15 +214,21 @@ class LocalSTT:
                 logger.info(f"檢測到GPU: {torch.cuda.get_device_name(0)}")
                 logger.info(f"GPU內存: {gpu_memory:.1f} GB")
                 
+                # Ampere及更新架構使用bfloat16（與float16同速但動態範圍更大），否則使用float16
+                if torch.cuda.get_device_capability(0)[0] >= 8:
+                    half_dtype, half_name = torch.bfloat16, "bfloat16"
+                else:
+                    half_dtype, half_name = torch.float16, "float16"
+                
                 # 根據GPU內存選擇最佳配置
-                if gpu_memory >= 8:  # 8GB以上使用float16
+                if gpu_memory >= 8:  # 8GB以上使用半精度
                     self.device = 0
-                    torch_dtype = torch.float16
-                    logger.info("使用GPU + float16 (最佳性能)")
-                elif gpu_memory >= 4:  # 4-8GB使用float16但啟用內存優化
+                    torch_dtype = half_dtype
+                    logger.info(f"使用GPU + {half_name} (最佳性能)")
+                elif gpu_memory >= 4:  # 4-8GB使用半精度但啟用內存優化
                     self.device = 0
-                    torch_dtype = torch.float16
-                    logger.info("使用GPU + float16 (內存優化)")
+                    torch_dtype = half_dtype
+                    logger.info(f"使用GPU + {half_name} (內存優化)")
                     # 啟用內存優化
                     torch.backends.cudnn.benchmark = True
                     torch.backends.cudnn.deterministic = False
@@ -73,34 +241,85 @@ class LocalSTT:
                 torch_dtype = torch.float32
                 logger.info("使用CPU")
             
-            # 設置CUDA內存分配策略
+            # CUDA內存分配策略已在模組導入時設置
+            if self.device >= 0:
+                logger.info(f"CUDA內存分配策略: {os.environ.get('PYTORCH_CUDA_ALLOC_CONF')}")
+            
+            # faster-whisper (CTranslate2) 後端
+            if self.backend == "faster_whisper":
+                if self._load_faster_whisper(model_path):
+                    logger.info("模型載入完成！")
+                    return True
+                logger.warning("faster-whisper後端不可用，回退到transformers後端")
+                self.backend = "transformers"
+            
+            self.torch_dtype = torch_dtype
+            
+            # ONNX Runtime後端（CPU）
+            model = None
+            if self.backend == "onnx":
+                if self.device < 0:
+                    model = self._load_onnx_model(model_path)
+                else:
+                    logger.info("ONNX後端僅用於CPU")
+                if model is None:
+                    logger.warning("ONNX後端不可用，回退到transformers後端")
+                    self.backend = "transformers"
+            
+            if model is None:
+                # 直接載入模型：默認使用SDPA融合attention，可用時改用Flash Attention 2
+                attn_implementation = "flash_attention_2" if self.device >= 0 and self._check_flash_attention() else "sdpa"
+                logger.info(f"Attention實現: {attn_implementation}")
+                
+                model = AutoModelForSpeechSeq2Seq.from_pretrained(
+                    model_path,
+                    torch_dtype=torch_dtype,
+                    low_cpu_mem_usage=True,
+                    attn_implementation=attn_implementation
+                )
+            self.processor = AutoProcessor.from_pretrained(model_path)
+            
+            # 如果使用GPU，將模型移到GPU（精度已由torch_dtype決定）
             if self.device >= 0:
-                # 啟用CUDA內存優化
-                torch.cuda.empty_cache()
-                # 設置內存分配策略
-                os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:128'
-                logger.info("已啟用CUDA內存優化")
+                model = model.to(f'cuda:{self.device}')
+                logger.info("模型已移至GPU")
             
+            # 推測解碼：由草稿模型提議token，主模型一次驗證
+            if self.assistant_model_path:
+                self._load_assistant_model(torch_dtype)
+            
+            # 長音頻按30秒分塊並批量推理
             self.model = pipeline(
                 "automatic-speech-recognition",
-                model=model_path,
-                device=self.device,
+                model=model,
+                tokenizer=self.processor.tokenizer,
+                feature_extractor=self.processor.feature_extractor,
+                chunk_length_s=30,
+                batch_size=1 if "assistant_model" in self.generate_kwargs else 8,
                 torch_dtype=torch_dtype,
-                model_kwargs={
-                    "low_cpu_mem_usage": True,
-                    "attn_implementation": "flash_attention_2" if self.device >= 0 and self._check_flash_attention() else "eager"
-                }
+                device=self.device
             )
             
-            # 如果使用GPU，將模型移到GPU並優化
+            # 為一個批次的30秒窗口log-mel特徵預分配pinned內存，用於異步拷貝到GPU
             if self.device >= 0:
-                # 確保模型在GPU上
-                if hasattr(self.model.model, 'to'):
-                    self.model.model = self.model.model.to(f'cuda:{self.device}')
-                # 啟用混合精度推理
-                if torch_dtype == torch.float16:
-                    self.model.model = self.model.model.half()
-                logger.info("模型已優化並移至GPU")
+                feature_extractor = self.processor.feature_extractor
+                self._pinned_features = torch.empty(
+                    (8, feature_extractor.feature_size, feature_extractor.nb_max_frames),
+                    dtype=torch.float32
+                ).pin_memory()
+                # 標記上一次從緩衝區發出的異步拷貝已完成，之後才能覆寫緩衝區
+                self._staging_done = torch.cuda.Event()
+            
+            # 在GPU上編譯encoder/decoder，減少kernel啟動和調度開銷
+            if self.device >= 0 and self.compile_model:
+                self.compiled = self._compile_model()
+            
+            # CPU上對Linear層做動態int8量化（ONNX後端已在導出時量化）
+            if self.device < 0 and self.cpu_int8 and self.backend != "onnx":
+                self.quantized = self._quantize_cpu_int8()
+            
+            if self.warmup_on_load:
+                self.warmup()
             
             logger.info("模型載入完成！")
             return True
@@ -109,138 +328,523 @@ class LocalSTT:
             logger.error(f"模型載入失敗: {str(e)}")
             return False
     
-    def _check_flash_attention(self):
-        """檢查Flash Attention是否可用"""
+    def _load_faster_whisper(self, model_path):
+        """使用faster-whisper (CTranslate2) 載入模型：CPU使用int8，GPU使用int8_float16"""
         try:
-            import flash_attn
-            logger.info("Flash Attention 2 可用，啟用性能優化")
-            return True
+            from faster_whisper import WhisperModel
         except ImportError:
-            logger.info("Flash Attention 2 未安裝，使用標準attention")
+            logger.warning("faster-whisper 未安裝")
+            return False
+        
+        try:
+            if self.device >= 0:
+                device, compute_type = "cuda", "int8_float16"
+            else:
+                device, compute_type = "cpu", "int8"
+            
+            self.model = WhisperModel(
+                model_path,
+                device=device,
+                device_index=max(self.device, 0),
+                compute_type=compute_type
+            )
+            logger.info(f"使用faster-whisper後端 ({device}, {compute_type})")
+            return True
+        except Exception as e:
+            logger.warning(f"faster-whisper模型載入失敗: {str(e)}")
+            self.model = None
             return False
     
-    def check_ffmpeg(self):
-        """檢查ffmpeg是否可用"""
+    def _load_onnx_model(self, model_path):
+        """
+        使用ONNX Runtime在CPU上推理，導出和量化結果緩存於磁盤，只在首次執行
+        
+        encoder使用per-tensor動態int8量化；decoder改用per-channel量化，盡量保持辨識準確率
+        """
         try:
-            import subprocess
-            import os
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForSpeechSeq2Seq, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError:
+            logger.warning("optimum[onnxruntime] 未安裝")
+            return None
+        
+        try:
+            cache_dir = os.path.join(ONNX_CACHE_DIR, re.sub(r'[^\w.-]+', '--', model_path).strip('-'))
             
-            # 首先檢查系統PATH中的ffmpeg
-            try:
-                result = subprocess.run(['ffmpeg', '-version'], 
-                                      capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    logger.info("找到系統PATH中的ffmpeg")
-                    return True
-            except:
-                pass
+            if not os.path.exists(os.path.join(cache_dir, 'config.json')):
+                logger.info("正在導出ONNX模型（僅首次執行）...")
+                ORTModelForSpeechSeq2Seq.from_pretrained(model_path, export=True).save_pretrained(cache_dir)
             
-            # 檢查本地ffmpeg_bin文件夾
-            local_ffmpeg_path = os.path.join(os.path.dirname(__file__), 'ffmpeg_bin', 'ffmpeg.exe')
-            if os.path.exists(local_ffmpeg_path):
-                try:
-                    result = subprocess.run([local_ffmpeg_path, '-version'], 
-                                          capture_output=True, text=True, timeout=5)
-                    if result.returncode == 0:
-                        logger.info("找到本地ffmpeg_bin中的ffmpeg")
-                        # 將本地ffmpeg路徑添加到環境變量
-                        os.environ['PATH'] = os.path.join(os.path.dirname(__file__), 'ffmpeg_bin') + os.pathsep + os.environ.get('PATH', '')
-                        return True
-                except:
-                    pass
-            
-            # 檢查當前目錄下的ffmpeg_bin
-            current_ffmpeg_path = os.path.join('ffmpeg_bin', 'ffmpeg.exe')
-            if os.path.exists(current_ffmpeg_path):
-                try:
-                    result = subprocess.run([current_ffmpeg_path, '-version'], 
-                                          capture_output=True, text=True, timeout=5)
-                    if result.returncode == 0:
-                        logger.info("找到當前目錄下的ffmpeg_bin中的ffmpeg")
-                        # 將ffmpeg_bin路徑添加到環境變量
-                        os.environ['PATH'] = os.path.abspath('ffmpeg_bin') + os.pathsep + os.environ.get('PATH', '')
-                        return True
-                except:
-                    pass
-            
-            logger.warning("未找到ffmpeg，將使用替代方法處理音頻")
+            onnx_files = [name for name in sorted(os.listdir(cache_dir)) if name.endswith('.onnx')]
+            if self.cpu_int8 and not any(name.endswith('_quantized.onnx') for name in onnx_files):
+                logger.info("正在量化ONNX模型（僅首次執行）...")
+                for name in onnx_files:
+                    qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=not name.startswith('encoder'))
+                    ORTQuantizer.from_pretrained(cache_dir, file_name=name).quantize(
+                        save_dir=cache_dir, quantization_config=qconfig
+                    )
+            
+            # 使用量化後的模型文件（optimum默認的導出文件名）
+            file_names = {}
+            if self.cpu_int8:
+                for key, stem in (('encoder_file_name', 'encoder_model'),
+                                  ('decoder_file_name', 'decoder_model'),
+                                  ('decoder_with_past_file_name', 'decoder_with_past_model')):
+                    if os.path.exists(os.path.join(cache_dir, f'{stem}_quantized.onnx')):
+                        file_names[key] = f'{stem}_quantized.onnx'
+            
+            # 啟用全部圖優化（節點融合、常量折疊等）
+            session_options = onnxruntime.SessionOptions()
+            session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            
+            model = ORTModelForSpeechSeq2Seq.from_pretrained(
+                cache_dir,
+                provider="CPUExecutionProvider",
+                session_options=session_options,
+                **file_names
+            )
+            self.quantized = bool(file_names)
+            logger.info(f"使用ONNX Runtime後端 (CPU{', int8' if self.quantized else ''})")
+            return model
+        except Exception as e:
+            logger.warning(f"ONNX模型載入失敗: {str(e)}")
+            return None
+    
+    def _load_assistant_model(self, torch_dtype):
+        """載入推測解碼用的草稿模型，失敗時使用普通貪婪解碼"""
+        try:
+            assistant = AutoModelForSpeechSeq2Seq.from_pretrained(
+                self.assistant_model_path,
+                torch_dtype=torch_dtype,
+                low_cpu_mem_usage=True
+            )
+            if self.device >= 0:
+                assistant = assistant.to(f'cuda:{self.device}')
+            self.generate_kwargs["assistant_model"] = assistant
+            logger.info(f"已啟用推測解碼，草稿模型: {self.assistant_model_path}")
+        except Exception as e:
+            logger.warning(f"草稿模型載入失敗，使用普通貪婪解碼: {str(e)}")
+    
+    def _compile_model(self):
+        """使用torch.compile包裝encoder/decoder，實際編譯在warmup()中觸發"""
+        if not hasattr(torch, 'compile'):
+            logger.info("當前PyTorch不支持torch.compile，跳過編譯")
+            return False
+        
+        model = self.model.model
+        encoder, decoder = model.get_encoder(), model.get_decoder()
+        original_forwards = (encoder.forward, decoder.forward)
+        
+        try:
+            import torch._dynamo
+            # 容忍輸入形狀變化帶來的重新編譯；encoder輸入固定為30秒窗口
+            torch._dynamo.config.cache_size_limit = 64
+            
+            encoder.forward = torch.compile(encoder.forward, mode="reduce-overhead")
+            decoder.forward = torch.compile(decoder.forward, mode="reduce-overhead")
+            
+            # 30秒以內的音頻使用靜態KV緩存：緩存只分配一次並在請求間重用，
+            # decoder輸入形狀固定，不會因序列變長而重新編譯（推測解碼不支持靜態緩存）
+            self.static_cache = StaticCache is not None and "assistant_model" not in self.generate_kwargs
+            
+            self._uncompiled_forwards = original_forwards
+            return True
+            
+        except Exception as e:
+            logger.warning(f"torch.compile 失敗，使用未編譯模型: {str(e)}")
+            encoder.forward, decoder.forward = original_forwards
+            self.static_cache = False
             return False
+    
+    def warmup(self):
+        """
+        預熱GPU模型：已編譯時按各批大小觸發編譯並捕獲CUDA graph，否則推理一次讓CUDA緩存分配器提前建立內存池
+        
+        reduce-overhead模式的CUDA graph按線程保存，必須在之後執行推理的同一線程中調用
+        """
+        if self.model is None or self.device is None or self.device < 0 or self.backend != "transformers":
+            return
+        
+        if self.compiled:
+            if self.static_cache:
+                try:
+                    self._build_static_caches()
+                except Exception as e:
+                    logger.warning(f"靜態KV緩存分配失敗，不使用靜態緩存: {str(e)}")
+                    self._static_caches = {}
+                    self.static_cache = False
             
+            try:
+                # 每個批大小各編譯一次，避免首個批量請求承擔編譯時間
+                logger.info("正在編譯模型...")
+                self._warmup(COMPILED_BATCH_SIZES if self.static_cache else (1,))
+                logger.info("torch.compile 編譯完成")
+                return
+            except Exception as e:
+                logger.warning(f"torch.compile 失敗，使用未編譯模型: {str(e)}")
+                model = self.model.model
+                model.get_encoder().forward, model.get_decoder().forward = self._uncompiled_forwards
+                self.compiled = False
+                self.static_cache = False
+                self._static_caches = {}
+        
+        try:
+            self._warmup()
+        except Exception as e:
+            logger.warning(f"模型預熱失敗: {str(e)}")
+    
+    def _build_static_caches(self):
+        """為COMPILED_BATCH_SIZES中的每個批大小預分配一份EncoderDecoderCache(StaticCache, StaticCache)"""
+        config = self.model.model.config
+        # 緩存只需覆蓋decoder各層（turbo模型的decoder層數遠少於encoder）
+        cache_config = copy.copy(config)
+        cache_config.num_hidden_layers = config.decoder_layers
+        
+        def new_cache(batch_size, max_cache_len):
+            kwargs = dict(config=cache_config, max_cache_len=max_cache_len,
+                          device=self.model.device, dtype=self.torch_dtype)
+            try:
+                return StaticCache(batch_size=batch_size, **kwargs)
+            except TypeError:
+                # 較舊的transformers使用max_batch_size參數名
+                return StaticCache(max_batch_size=batch_size, **kwargs)
+        
+        # decoder自注意力按最大生成長度，cross-attention按encoder輸出長度（30秒窗口）
+        self._static_caches = {
+            batch_size: EncoderDecoderCache(
+                new_cache(batch_size, config.max_target_positions),
+                new_cache(batch_size, config.max_source_positions)
+            )
+            for batch_size in COMPILED_BATCH_SIZES
+        }
+    
+    def _warmup(self, batch_sizes=(1,)):
+        """以30秒靜音按各批大小執行推理"""
+        logger.info("正在預熱模型...")
+        silence = np.zeros(16000 * 30, dtype=np.float32)
+        for batch_size in batch_sizes:
+            if batch_size == 1:
+                self._run_inference({"array": silence, "sampling_rate": 16000})
+            else:
+                self._transcribe_arrays([silence] * batch_size, batch_size)
+        logger.info("模型預熱完成")
+    
+    def _quantize_cpu_int8(self):
+        """對Linear層做動態int8量化（LayerNorm/Conv1d保持float32）"""
+        try:
+            self.model.model = torch.quantization.quantize_dynamic(
+                self.model.model,
+                {torch.nn.Linear},
+                dtype=torch.qint8
+            )
+            logger.info("已啟用CPU動態int8量化 (Linear層)")
+            return True
         except Exception as e:
-            logger.warning(f"檢查ffmpeg時發生錯誤: {e}")
+            logger.warning(f"int8量化失敗，使用float32模型: {str(e)}")
+            return False
+    
+    def _check_flash_attention(self):
+        """檢查Flash Attention是否可用"""
+        try:
+            import flash_attn
+            logger.info("Flash Attention 2 可用，啟用性能優化")
+            return True
+        except ImportError:
+            logger.info("Flash Attention 2 未安裝，使用SDPA attention")
             return False
     
+    def check_ffmpeg(self):
+        """檢查ffmpeg是否可用（結果緩存於實例）"""
+        if self._ffmpeg_ok is None:
+            try:
+                self._ffmpeg_ok = find_ffmpeg() is not None
+            except Exception as e:
+                logger.warning(f"檢查ffmpeg時發生錯誤: {e}")
+                self._ffmpeg_ok = False
+        return self._ffmpeg_ok
+    
     def preprocess_audio(self, audio_file_path):
-        """預處理音頻文件"""
+        """
+        預處理音頻文件
+        
+        優先使用soundfile解碼，soundfile不支援的編碼（如m4a）才透過librosa + ffmpeg解碼
+        
+        Returns:
+            tuple: (float32單聲道16kHz音頻數組, 採樣率)
+        """
         try:
-            # 檢查ffmpeg是否可用
-            if not self.check_ffmpeg():
-                logger.warning("ffmpeg未安裝，嘗試使用替代方法...")
-                return self.preprocess_audio_alternative(audio_file_path)
-            
-            # 使用librosa讀取音頻（需要ffmpeg）
             try:
+                audio, sr = sf.read(audio_file_path, dtype='float32', always_2d=False)
+            except RuntimeError as e:
+                if not self._ffmpeg_ok:
+                    raise
+                logger.info(f"soundfile無法解碼，改用librosa: {e}")
                 import librosa
-                audio, sr = librosa.load(audio_file_path, sr=16000)
-                
-                # 確保是單聲道
-                if len(audio.shape) > 1:
-                    audio = np.mean(audio, axis=1)
-                
-                # 標準化音量
-                audio = librosa.util.normalize(audio)
-                
-                # 保存為臨時文件
-                temp_file = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
-                sf.write(temp_file.name, audio, sr)
-                
-                return temp_file.name, sr
-                
-            except ImportError:
-                logger.warning("librosa未安裝，使用替代方法...")
-                return self.preprocess_audio_alternative(audio_file_path)
+                audio, sr = librosa.load(audio_file_path, sr=None, mono=True)
+            
+            return self._prepare_waveform(audio, sr)
                 
         except Exception as e:
             logger.error(f"音頻預處理失敗: {str(e)}")
             raise e
     
-    def preprocess_audio_alternative(self, audio_file_path):
-        """替代的音頻預處理方法（不依賴ffmpeg）"""
+    def preprocess_audio_buffer(self, buffer, suffix='.wav'):
+        """
+        預處理內存中的音頻數據
+        
+        Args:
+            buffer: 包含音頻數據的文件對象（如io.BytesIO）
+            suffix: 原始文件擴展名，soundfile無法解碼時用於臨時文件
+            
+        Returns:
+            tuple: (float32單聲道16kHz音頻數組, 採樣率)
+        """
         try:
-            # 直接使用soundfile讀取（僅支持有限格式）
-            audio, sr = sf.read(audio_file_path)
+            audio, sr = sf.read(buffer, dtype='float32', always_2d=False)
+        except RuntimeError:
+            # 優先用PyAV直接在內存中解碼
+            if av is not None:
+                buffer.seek(0)
+                try:
+                    audio, sr = decode_audio_av(buffer)
+                    return self._prepare_waveform(audio, sr)
+                except Exception as e:
+                    logger.info(f"PyAV無法解碼內存中的音頻: {e}")
             
-            # 轉換為float32
-            if audio.dtype != np.float32:
-                audio = audio.astype(np.float32)
+            # 最後才寫入臨時文件交給librosa + ffmpeg
+            logger.info("soundfile無法解碼內存中的音頻，改用臨時文件處理")
+            buffer.seek(0)
+            with temp_audio_file(buffer, suffix) as temp_path:
+                return self.preprocess_audio(temp_path)
+        
+        return self._prepare_waveform(audio, sr)
+    
+    def _prepare_waveform(self, audio, sr):
+        """轉為單聲道、重採樣到16kHz並標準化音量"""
+        # 確保是單聲道的連續float32數組（降混時直接以float32累加）
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1, dtype=np.float32)
+        else:
+            audio = np.ascontiguousarray(audio, dtype=np.float32)
+        
+        # 重採樣到16kHz（如果需要）
+        if sr != 16000:
+            audio = resample_audio(audio, sr, 16000)
+            sr = 16000
+        
+        # 標準化音量：峰值只計算一次，原地縮放不額外分配內存
+        if audio.size:
+            peak = max(float(audio.max()), -float(audio.min()))
+            np.multiply(audio, 1.0 / (peak + 1e-8), out=audio)
+        
+        return audio, sr
+    
+    def _run_inference(self, audio_input):
+        """
+        對單個音頻執行語音辨識
+        
+        Args:
+            audio_input: {"array": ..., "sampling_rate": ...} 字典
             
-            # 確保是單聲道
-            if len(audio.shape) > 1:
-                audio = np.mean(audio, axis=1)
+        Returns:
+            str: 辨識文本
+        """
+        if self.backend == "faster_whisper":
+            if isinstance(audio_input, dict):
+                audio_input = audio_input["array"]
+            segments, info = self.model.transcribe(
+                audio_input,
+                language="zh",
+                beam_size=1,
+                temperature=0.0,
+                condition_on_previous_text=False
+            )
+            return "".join(segment.text for segment in segments).strip()
+        
+        return self._transcribe_arrays([audio_input["array"]], batch_size=1)[0]
+    
+    def _transcribe_arrays(self, arrays, batch_size=8):
+        """
+        批量辨識16kHz單聲道音頻數組
+        
+        30秒以內的音頻自行提取log-mel特徵後直接調用model.generate，
+        更長的音頻交給分塊pipeline處理。
+        
+        Returns:
+            list: 與輸入順序對應的辨識文本
+        """
+        if self.backend == "faster_whisper":
+            # CTranslate2後端逐個辨識
+            return [self._run_inference({"array": audio, "sampling_rate": 16000}) for audio in arrays]
+        
+        # 推測解碼只支持單個樣本
+        if "assistant_model" in self.generate_kwargs:
+            batch_size = 1
+        
+        transcriptions = [None] * len(arrays)
+        n_samples = self.processor.feature_extractor.n_samples
+        short_indices = [i for i, audio in enumerate(arrays) if len(audio) <= n_samples]
+        long_indices = [i for i, audio in enumerate(arrays) if len(audio) > n_samples]
+        
+        for start in range(0, len(short_indices), batch_size):
+            indices = short_indices[start:start + batch_size]
+            texts = self._generate_short([arrays[i] for i in indices])
+            for i, text in zip(indices, texts):
+                transcriptions[i] = text
+        
+        if long_indices:
+            outputs = self.model(
+                [{"array": arrays[i], "sampling_rate": 16000} for i in long_indices],
+                batch_size=batch_size,
+                generate_kwargs=self.generate_kwargs
+            )
+            for i, output in zip(long_indices, outputs):
+                transcriptions[i] = output["text"]
+        
+        return transcriptions
+    
+    def _generate_short(self, arrays):
+        """
+        辨識一批30秒以內的16kHz音頻
+        
+        在CPU上一次性提取log-mel特徵並直接傳給model.generate，不經過pipeline的重複預處理
+        """
+        return self._generate_features(self._extract_features(arrays))
+    
+    def _extract_features(self, arrays):
+        """提取一批30秒以內16kHz音頻的log-mel特徵（CPU上的float32張量）"""
+        return self.processor.feature_extractor(
+            arrays, sampling_rate=16000, return_tensors="pt"
+        ).input_features
+    
+    def _generate_features(self, features, prompt_ids=None):
+        """
+        由log-mel特徵生成辨識文本
+        
+        GPU上特徵先拷入預分配的pinned緩衝區，再以non_blocking方式異步拷貝，
+        主機端不等拷貝完成即繼續準備generate。同一實例的推理應在單個線程中進行。
+        
+        Args:
+            features: _extract_features返回的特徵
+            prompt_ids: 作為上文提示的token（僅用於單個樣本）
+            
+        Returns:
+            list: 每個樣本的辨識文本
+        """
+        count = len(features)
+        generate_kwargs = self.generate_kwargs
+        if prompt_ids is not None:
+            # 提示長度每次不同，不使用為固定形狀準備的靜態緩存
+            generate_kwargs = dict(generate_kwargs, prompt_ids=prompt_ids.to(self.model.device))
+        elif self.static_cache:
+            # 補齊到已預熱的批大小，重複最後一條使補齊樣本與其同時結束解碼
+            padded_size = next((size for size in COMPILED_BATCH_SIZES if size >= count), count)
+            if padded_size > count:
+                features = torch.cat([features, features[-1:].expand(padded_size - count, -1, -1)])
+            cache = self._static_caches.get(padded_size)
+            if cache is not None:
+                # 重用預分配的緩存，生成前清空上一批的內容
+                cache.reset()
+                generate_kwargs = dict(generate_kwargs, past_key_values=cache)
+            else:
+                generate_kwargs = dict(generate_kwargs, cache_implementation="static")
+        
+        if self._pinned_features is not None and len(features) <= len(self._pinned_features):
+            # 上一批的異步拷貝完成前不能覆寫緩衝區（通常早已完成）
+            self._staging_done.synchronize()
+            staging = self._pinned_features[:len(features)]
+            staging.copy_(features)
+            # 先以原始float32異步拷貝，再在GPU上轉換精度
+            input_features = staging.to(self.model.device, non_blocking=True)
+            self._staging_done.record()
+            input_features = input_features.to(self.torch_dtype)
+        else:
+            input_features = features.to(self.model.device, dtype=self.torch_dtype)
+        
+        with torch.inference_mode():
+            tokens = self.model.model.generate(input_features=input_features, **generate_kwargs)
+        
+        return self.processor.batch_decode(tokens[:count], skip_special_tokens=True)
+    
+    def _validate_audio_file(self, audio_file_path):
+        """檢查音頻文件是否存在且格式受支援，返回錯誤信息或None"""
+        # 檢查文件是否存在
+        if not os.path.exists(audio_file_path):
+            return f"音頻文件不存在: {audio_file_path}"
+        
+        # 檢查文件類型
+        file_ext = os.path.splitext(audio_file_path.lower())[1]
+        
+        if file_ext not in SUPPORTED_AUDIO_EXT:
+            return f"不支援的音頻格式: {file_ext}，請使用 {', '.join(SUPPORTED_AUDIO_TUPLE)}"
+        
+        # 檢查ffmpeg依賴
+        if file_ext in FFMPEG_AUDIO_EXT and not self._ffmpeg_ok:
+            logger.warning(f"處理 {file_ext} 格式需要ffmpeg，建議安裝ffmpeg以獲得最佳支持")
+        
+        return None
+    
+    def transcribe_file(self, audio_file_path, long_context=False):
+        """
+        辨識音頻文件
+        
+        Args:
+            audio_file_path: 音頻文件路徑
+            long_context: 是否使用transcribe_long按窗口順序辨識，以上文作為提示
+            
+        Returns:
+            dict: 包含辨識結果的字典
+        """
+        if self.model is None:
+            return {"error": "模型尚未載入"}
+        
+        try:
+            error = self._validate_audio_file(audio_file_path)
+            if error:
+                return {"error": error}
             
-            # 標準化音量
-            audio = audio / (np.max(np.abs(audio)) + 1e-8)
+            # 預處理音頻（直接在內存中傳給模型）
+            audio, sample_rate = self.preprocess_audio(audio_file_path)
             
-            # 重採樣到16kHz（如果需要）
-            if sr != 16000:
-                logger.warning(f"音頻採樣率 {sr}Hz 不是16kHz，可能影響辨識效果")
+            # 執行語音辨識
+            logger.info("開始語音辨識...")
             
-            # 保存為臨時文件
-            temp_file = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
-            sf.write(temp_file.name, audio, sr)
+            if long_context:
+                result = self.transcribe_long(audio, sample_rate)
+                if result.get('success'):
+                    result['file_path'] = audio_file_path
+                return result
             
-            return temp_file.name, sr
+            transcription = self._run_inference({"array": audio, "sampling_rate": sample_rate})
+            logger.info(f"辨識結果: {transcription}")
             
+            return {
+                'success': True,
+                'transcription': transcription,
+                'language': 'zh',
+                'sample_rate': sample_rate,
+                'file_path': audio_file_path
+            }
+                    
         except Exception as e:
-            logger.error(f"替代音頻預處理失敗: {str(e)}")
-            raise e
+            logger.error(f"語音辨識失敗: {str(e)}")
+            return {"error": f"語音辨識失敗: {str(e)}"}
     
-    def transcribe_file(self, audio_file_path):
+    def transcribe_long(self, audio, sample_rate=16000, max_prompt_chars=100):
         """
-        辨識音頻文件
+        按30秒窗口順序辨識長音頻，並以上一窗口的辨識結果作為下一窗口的提示
+        
+        下一窗口的log-mel特徵在後台線程上提取，與當前窗口的推理重疊。
+        Whisper的cross-attention依賴各窗口自己的encoder輸出，decoder的KV緩存無法跨窗口重用，
+        上下文改以prompt_ids傳遞。吞吐量不如transcribe_array的批量分塊，但窗口之間語句更連貫。
+        下一窗口的encoder不與當前窗口的decoder並行：兩者在同一GPU上競爭計算資源，
+        逐token解碼每步都會與主機同步，編譯路徑的CUDA graph也綁定在默認流上，並行收益有限。
         
         Args:
-            audio_file_path: 音頻文件路徑
+            audio: float32音頻數組
+            sample_rate: 音頻採樣率，非16kHz時會先重採樣
+            max_prompt_chars: 作為提示的上文最多保留的字數
             
         Returns:
             dict: 包含辨識結果的字典
@@ -248,60 +852,269 @@ class LocalSTT:
         if self.model is None:
             return {"error": "模型尚未載入"}
         
+        if sample_rate != 16000:
+            audio, sample_rate = self._prepare_waveform(audio, sample_rate)
+        
+        # faster-whisper自身即按窗口順序解碼
+        if self.backend == "faster_whisper":
+            return self.transcribe_array(audio)
+        
         try:
-            # 檢查文件是否存在
-            if not os.path.exists(audio_file_path):
-                return {"error": f"音頻文件不存在: {audio_file_path}"}
+            n_samples = self.processor.feature_extractor.n_samples
+            windows = [audio[start:start + n_samples] for start in range(0, max(len(audio), 1), n_samples)]
             
-            # 檢查文件類型
-            supported_formats = {'.wav', '.mp3', '.m4a', '.flac', '.ogg'}
-            file_ext = os.path.splitext(audio_file_path.lower())[1]
+            texts = []
+            prompt_ids = None
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(self._extract_features, windows[:1])
+                for i in range(len(windows)):
+                    features = future.result()
+                    # 當前窗口推理期間預先提取下一窗口的特徵
+                    if i + 1 < len(windows):
+                        future = executor.submit(self._extract_features, windows[i + 1:i + 2])
+                    
+                    text = self._generate_features(features, prompt_ids)[0]
+                    texts.append(text)
+                    
+                    context = ''.join(texts)[-max_prompt_chars:].strip()
+                    if context:
+                        prompt_ids = self.processor.get_prompt_ids(context, return_tensors="pt")
             
-            if file_ext not in supported_formats:
-                return {"error": f"不支援的音頻格式: {file_ext}，請使用 {', '.join(supported_formats)}"}
+            transcription = ''.join(texts)
+            logger.info(f"辨識結果: {transcription}")
             
-            # 檢查ffmpeg依賴
-            if file_ext in {'.mp3', '.m4a', '.ogg'} and not self.check_ffmpeg():
-                logger.warning(f"處理 {file_ext} 格式需要ffmpeg，建議安裝ffmpeg以獲得最佳支持")
+            return {
+                'success': True,
+                'transcription': transcription,
+                'language': 'zh',
+                'sample_rate': 16000
+            }
             
-            # 預處理音頻
-            temp_file_path, sample_rate = self.preprocess_audio(audio_file_path)
+        except Exception as e:
+            logger.error(f"語音辨識失敗: {str(e)}")
+            return {"error": f"語音辨識失敗: {str(e)}"}
+    
+    def transcribe_array(self, audio, sample_rate=16000):
+        """
+        辨識內存中的音頻數組
+        
+        Args:
+            audio: float32音頻數組
+            sample_rate: 音頻採樣率，非16kHz時會先重採樣
+            
+        Returns:
+            dict: 包含辨識結果的字典
+        """
+        if sample_rate != 16000:
+            audio, sample_rate = self._prepare_waveform(audio, sample_rate)
+        return self.transcribe_arrays([audio])[0]
+    
+    def extract_features(self, arrays):
+        """
+        提前提取一批音頻的log-mel特徵，可在推理線程之外的CPU線程上調用
+        
+        Args:
+            arrays: 16kHz單聲道float32音頻數組列表
             
+        Returns:
+            torch.Tensor: 可傳給transcribe_arrays的特徵；
+                          該批無法整批直接推理（長音頻、faster_whisper後端或推測解碼）時返回None
+        """
+        if (self.model is None or self.backend == "faster_whisper"
+                or "assistant_model" in self.generate_kwargs):
+            return None
+        
+        n_samples = self.processor.feature_extractor.n_samples
+        if not arrays or any(len(audio) > n_samples for audio in arrays):
+            return None
+        
+        return self._extract_features(arrays)
+    
+    def transcribe_arrays(self, arrays, batch_size=8, features=None):
+        """
+        批量辨識已預處理的16kHz單聲道音頻數組
+        
+        Args:
+            arrays: float32音頻數組列表
+            batch_size: 每批送入模型的音頻數量
+            features: extract_features提前提取的特徵，提供時整批直接推理
+            
+        Returns:
+            list: 與輸入順序一一對應的辨識結果字典
+        """
+        if self.model is None:
+            return [{"error": "模型尚未載入"} for _ in arrays]
+        
+        try:
+            if features is not None and len(features) == len(arrays):
+                transcriptions = self._generate_features(features)
+            else:
+                transcriptions = self._transcribe_arrays(arrays, batch_size)
+        except Exception as e:
+            logger.error(f"語音辨識失敗: {str(e)}")
+            return [{"error": f"語音辨識失敗: {str(e)}"} for _ in arrays]
+        
+        return [
+            {
+                'success': True,
+                'transcription': transcription,
+                'language': 'zh',
+                'sample_rate': 16000
+            }
+            for transcription in transcriptions
+        ]
+    
+    def transcribe_files(self, audio_file_paths, batch_size=8):
+        """
+        批量辨識多個音頻文件
+        
+        Args:
+            audio_file_paths: 音頻文件路徑列表
+            batch_size: 每批送入模型的音頻數量
+            
+        Returns:
+            list: 與輸入順序一一對應的辨識結果字典
+        """
+        return [result for _, result in self.iter_transcribe_files(audio_file_paths, batch_size)]
+    
+    def iter_transcribe_files(self, audio_file_paths, batch_size=8, num_workers=4):
+        """
+        流式批量辨識音頻文件
+        
+        生產者線程遍歷路徑並提交給線程池預處理，結果按順序放入有界隊列；
+        主線程從隊列取出已就緒的音頻組成批次執行推理，每批完成後立即產出結果。
+        
+        Args:
+            audio_file_paths: 音頻文件路徑的可迭代對象（可以是生成器）
+            batch_size: 每批送入模型的音頻數量
+            num_workers: 預處理線程數
+            
+        Yields:
+            tuple: (音頻文件路徑, 辨識結果字典)，順序與輸入一致
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size必須大於0: {batch_size}")
+        
+        if self.model is None:
+            for audio_file_path in audio_file_paths:
+                yield audio_file_path, {"error": "模型尚未載入"}
+            return
+        
+        # 最多提前預處理兩個批次，避免大目錄佔用過多內存
+        prefetch = queue.Queue(maxsize=batch_size * 2)
+        stop = threading.Event()
+        producer_error = []
+        
+        def put(item):
+            """放入隊列，消費者提前結束時放棄"""
+            while not stop.is_set():
+                try:
+                    prefetch.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def produce(executor):
             try:
-                # 執行語音辨識
-                logger.info("開始語音辨識...")
+                for path in audio_file_paths:
+                    if not put((path, executor.submit(self._load_audio_file, path))):
+                        return
+            except Exception as e:
+                producer_error.append(e)
+            finally:
+                put(None)
+        
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            producer = threading.Thread(target=produce, args=(executor,), daemon=True)
+            producer.start()
+            
+            try:
+                finished = False
+                while not finished:
+                    batch = []
+                    while len(batch) < batch_size:
+                        item = prefetch.get()
+                        if item is None:
+                            finished = True
+                            break
+                        path, future = item
+                        batch.append((path, future.result()))
+                    
+                    if batch:
+                        yield from self._transcribe_batch(batch, batch_size)
                 
-                # 如果使用GPU，清理GPU內存
-                if self.device >= 0:
-                    torch.cuda.empty_cache()
+                if producer_error:
+                    raise producer_error[0]
+                    
+            finally:
+                stop.set()
+                producer.join()
+    
+    def _load_audio_file(self, audio_file_path):
+        """
+        檢查並預處理單個音頻文件（在線程池中執行）
+        
+        Returns:
+            tuple: (音頻數組, 採樣率, 錯誤信息)，成功時錯誤信息為None
+        """
+        error = self._validate_audio_file(audio_file_path)
+        if error:
+            return None, None, error
+        
+        try:
+            audio, sample_rate = self.preprocess_audio(audio_file_path)
+            return audio, sample_rate, None
+        except Exception as e:
+            return None, None, f"音頻預處理失敗: {str(e)}"
+    
+    def _transcribe_batch(self, batch, batch_size):
+        """
+        對一批已預處理的音頻執行推理
+        
+        Args:
+            batch: [(音頻文件路徑, (音頻數組, 採樣率, 錯誤信息)), ...]
+            batch_size: 每批送入模型的音頻數量
+            
+        Yields:
+            tuple: (音頻文件路徑, 辨識結果字典)
+        """
+        results = [None] * len(batch)
+        inputs = []
+        input_indices = []
+        
+        for i, (audio_file_path, (audio, sample_rate, error)) in enumerate(batch):
+            if error:
+                results[i] = {"error": error}
+            else:
+                inputs.append({"array": audio, "sampling_rate": sample_rate})
+                input_indices.append(i)
+        
+        if inputs:
+            try:
+                logger.info(f"開始批量語音辨識，共 {len(inputs)} 個文件...")
                 
-                result = self.model(
-                    temp_file_path,
-                    generate_kwargs={
-                        "language": "zh",  # 中文
-                        "task": "transcribe"
-                    }
+                transcriptions = self._transcribe_arrays(
+                    [audio_input["array"] for audio_input in inputs], batch_size
                 )
                 
-                transcription = result["text"]
-                logger.info(f"辨識結果: {transcription}")
-                
-                return {
-                    'success': True,
-                    'transcription': transcription,
-                    'language': 'zh',
-                    'sample_rate': sample_rate,
-                    'file_path': audio_file_path
-                }
-                
-            finally:
-                # 清理臨時文件
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
+                for i, transcription in zip(input_indices, transcriptions):
+                    audio_file_path, (_, sample_rate, _) = batch[i]
+                    results[i] = {
+                        'success': True,
+                        'transcription': transcription,
+                        'language': 'zh',
+                        'sample_rate': sample_rate,
+                        'file_path': audio_file_path
+                    }
                     
-        except Exception as e:
-            logger.error(f"語音辨識失敗: {str(e)}")
-            return {"error": f"語音辨識失敗: {str(e)}"}
+            except Exception as e:
+                logger.error(f"批量語音辨識失敗: {str(e)}")
+                for i in input_indices:
+                    results[i] = {"error": f"語音辨識失敗: {str(e)}"}
+        
+        for (audio_file_path, _), result in zip(batch, results):
+            yield audio_file_path, result
     
     def transcribe_url(self, audio_url):
         """
@@ -317,53 +1130,35 @@ class LocalSTT:
             return {"error": "模型尚未載入"}
         
         try:
-            # 下載音頻文件
+            # 下載音頻到內存，不落盤
+            import io
             import requests
+            from urllib.parse import urlparse
             response = requests.get(audio_url, stream=True)
             response.raise_for_status()
             
-            # 保存為臨時文件
-            temp_file = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
-            for chunk in response.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
-            temp_file.close()
+            buffer = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=65536):
+                buffer.write(chunk)
+            buffer.seek(0)
             
-            try:
-                # 預處理音頻
-                temp_file_path, sample_rate = self.preprocess_audio(temp_file.name)
-                
-                # 執行語音辨識
-                logger.info("開始語音辨識...")
-                
-                # 如果使用GPU，清理GPU內存
-                if self.device >= 0:
-                    torch.cuda.empty_cache()
-                
-                result = self.model(
-                    temp_file_path,
-                    generate_kwargs={
-                        "language": "zh",
-                        "task": "transcribe"
-                    }
-                )
-                
-                transcription = result["text"]
-                logger.info(f"辨識結果: {transcription}")
-                
-                return {
-                    'success': True,
-                    'transcription': transcription,
-                    'language': 'zh',
-                    'sample_rate': sample_rate,
-                    'url': audio_url
-                }
-                
-            finally:
-                # 清理臨時文件
-                if os.path.exists(temp_file.name):
-                    os.unlink(temp_file.name)
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
+            # 預處理音頻
+            suffix = os.path.splitext(urlparse(audio_url).path)[1] or '.wav'
+            audio, sample_rate = self.preprocess_audio_buffer(buffer, suffix=suffix)
+            
+            # 執行語音辨識
+            logger.info("開始語音辨識...")
+            
+            transcription = self._run_inference({"array": audio, "sampling_rate": sample_rate})
+            logger.info(f"辨識結果: {transcription}")
+            
+            return {
+                'success': True,
+                'transcription': transcription,
+                'language': 'zh',
+                'sample_rate': sample_rate,
+                'url': audio_url
+            }
                     
         except Exception as e:
             logger.error(f"語音辨識失敗: {str(e)}")
@@ -385,10 +1180,14 @@ class LocalSTT:
             'base_model': 'openai/whisper-large-v3-turbo',
             'language': 'Taiwanese (Taiwanese Hokkien)',
             'device': device_info,
+            'backend': self.backend,
             'sample_rate': 16000,
             'model_loaded': True,
-            'ffmpeg_available': self.check_ffmpeg(),
-            'gpu_optimized': self.device >= 0
+            'ffmpeg_available': self._ffmpeg_ok,
+            'gpu_optimized': self.device >= 0,
+            'compiled': self.compiled,
+            'static_kv_cache': self.static_cache,
+            'int8_quantized': self.quantized
         }
     
     def is_ready(self):
@@ -401,15 +1200,21 @@ class LocalSTT:
             torch.cuda.empty_cache()
             logger.info("GPU內存已清理")
 
-# 全局實例
-_stt_instance = None
+# 全局實例（按模型路徑區分）
+_stt_instances = {}
+_stt_instances_lock = threading.Lock()
 
 def get_stt_instance(model_path=None):
-    """獲取STT實例（單例模式）"""
-    global _stt_instance
-    if _stt_instance is None:
-        _stt_instance = LocalSTT(model_path)
-    return _stt_instance
+    """獲取STT實例（每個模型路徑一個單例，線程安全）"""
+    instance = _stt_instances.get(model_path)
+    if instance is None:
+        with _stt_instances_lock:
+            # 再次檢查，避免多個線程同時載入同一模型
+            instance = _stt_instances.get(model_path)
+            if instance is None:
+                instance = LocalSTT(model_path)
+                _stt_instances[model_path] = instance
+    return instance
 
 def transcribe_audio_file(audio_file_path, model_path=None):
     """
@@ -437,4 +1242,4 @@ def transcribe_audio_url(audio_url, model_path=None):
         dict: 辨識結果
     """
     stt = get_stt_instance(model_path)
-    return stt.transcribe_audio_url(audio_url)
+    return stt.transcribe_url(audio_url)
@@ -8,6 +8,7 @@ import os
 import sys
 import argparse
 import logging
+import importlib.util
 from pathlib import Path
 
 def setup_logging(verbose=False):
@@ -19,7 +20,7 @@ def setup_logging(verbose=False):
     )
 
 def check_dependencies():
-    """檢查依賴"""
+    """檢查依賴（只查找模組，不執行導入）"""
     required_packages = [
         'flask', 'flask-cors', 'torch', 'transformers', 
         'librosa', 'soundfile', 'numpy'
@@ -28,10 +29,9 @@ def check_dependencies():
     missing_packages = []
     
     for package in required_packages:
-        try:
-            __import__(package.replace('-', '_'))
+        if importlib.util.find_spec(package.replace('-', '_')) is not None:
             logging.info(f"✅ {package} 已安裝")
-        except ImportError:
+        else:
             missing_packages.append(package)
             logging.warning(f"❌ {package} 未安裝")
     
@@ -61,18 +61,18 @@ def check_model():
         logging.info("請確保已下載模型文件")
         return False
 
-def start_web_api(host="0.0.0.0", port=5000, verbose=False):
-    """啟動Web API服務"""
+def start_web_api(host="0.0.0.0", port=5000, verbose=False, threads=None):
+    """啟動Web API服務（threads為None時使用默認的waitress工作線程數）"""
     logging.info("🌐 啟動Web API服務...")
     
     try:
-        from voice_api_enhanced import app, init_stt
+        from voice_api_enhanced import init_stt_async, run_server, SERVER_THREADS
         
-        # 初始化STT模型
-        init_stt()
+        # 在後台初始化STT模型，服務同時開始監聽
+        init_stt_async()
         
-        # 啟動Flask服務
-        app.run(host=host, port=port, debug=verbose)
+        # 啟動HTTP服務
+        run_server(host=host, port=port, threads=threads or SERVER_THREADS, debug=verbose)
         
     except ImportError as e:
         logging.error(f"❌ 無法導入API模組: {e}")
@@ -110,6 +110,9 @@ def main():
   # 啟動Web API服務 (指定端口)
   python start_api.py --port 8080
   
+  # 啟動Web API服務 (指定工作線程數)
+  python start_api.py --threads 64
+  
   # 啟動Web API服務 (僅本地訪問)
   python start_api.py --local
   
@@ -127,11 +130,14 @@ def main():
     parser.add_argument('--cli', action='store_true', help='啟動CLI工具而不是Web API')
     parser.add_argument('--host', default='0.0.0.0', help='綁定主機地址 (默認: 0.0.0.0)')
     parser.add_argument('--port', type=int, default=5000, help='綁定端口 (默認: 5000)')
+    parser.add_argument('--threads', type=int, default=None, help='waitress工作線程數 (默認: 批大小的4倍)')
     parser.add_argument('--local', action='store_true', help='僅本地訪問 (綁定到127.0.0.1)')
     parser.add_argument('--verbose', '-v', action='store_true', help='詳細輸出')
     parser.add_argument('--check', action='store_true', help='僅檢查依賴和模型')
     
     args = parser.parse_args()
+    if args.threads is not None and args.threads < 1:
+        parser.error('--threads 必須大於0')
     
     # 設置日誌
     setup_logging(args.verbose)
@@ -139,8 +145,8 @@ def main():
     logging.info("🎯 台語語音辨識統一啟動腳本")
     logging.info("=" * 50)
     
-    # 檢查依賴
-    if not check_dependencies():
+    # 檢查依賴（僅在檢查模式下執行，缺失的包在正常啟動時會於導入時直接報錯）
+    if args.check and not check_dependencies():
         logging.error("❌ 依賴檢查失敗")
         sys.exit(1)
     
@@ -172,7 +178,7 @@ def main():
         else:
             logging.info(f"   訪問地址: http://{args.host}:{args.port}")
         
-        success = start_web_api(args.host, args.port, args.verbose)
+        success = start_web_api(args.host, args.port, args.verbose, args.threads)
     
     if not success:
         logging.error("❌ 啟動失敗")
@@ -7,7 +7,8 @@
 import argparse
 import sys
 import os
-from local_stt import LocalSTT
+import time
+from local_stt import LocalSTT, SUPPORTED_AUDIO_TUPLE
 
 def main():
     parser = argparse.ArgumentParser(
@@ -24,6 +25,9 @@ def main():
   # 批量處理目錄中的音頻文件
   python stt_cli.py --batch audio_folder/ -o results/
   
+  # 長音頻按窗口順序辨識，以上文作為提示
+  python stt_cli.py long_audio.wav --long-context
+  
   # 顯示模型信息
   python stt_cli.py --info
   
@@ -36,13 +40,22 @@ def main():
     parser.add_argument('audio_file', nargs='?', help='音頻文件路徑')
     parser.add_argument('--output', '-o', help='輸出文件路徑')
     parser.add_argument('--batch', help='批量處理目錄路徑')
+    parser.add_argument('--batch-size', type=int, default=8, help='批量處理時每批送入模型的文件數 (默認: 8)')
     parser.add_argument('--info', action='store_true', help='顯示模型信息')
     parser.add_argument('--model-path', help='自定義模型路徑')
+    parser.add_argument('--backend', choices=['transformers', 'faster_whisper', 'onnx'], default='transformers',
+                        help='推理後端 (默認: transformers；faster_whisper需要CTranslate2格式模型；onnx僅用於CPU)')
+    parser.add_argument('--assistant-model', help='推測解碼用的草稿模型路徑（可選）')
+    parser.add_argument('--long-context', action='store_true',
+                        help='單文件辨識時按30秒窗口順序解碼，並以上一窗口的結果作為提示（長音頻語句更連貫）')
     parser.add_argument('--verbose', '-v', action='store_true', help='詳細輸出')
     parser.add_argument('--simple', action='store_true', help='簡單模式（無需參數）')
     
     args = parser.parse_args()
     
+    if args.batch_size < 1:
+        parser.error('--batch-size 必須大於0')
+    
     # 簡單模式 - 如果沒有參數，顯示幫助
     if not args.simple and not any([args.audio_file, args.batch, args.info]):
         parser.print_help()
@@ -59,7 +72,7 @@ def main():
         print("🎯 台語語音辨識統一工具")
         print("=" * 50)
         
-        stt = LocalSTT(args.model_path)
+        stt = LocalSTT(args.model_path, backend=args.backend, assistant_model_path=args.assistant_model)
         
         if not stt.is_ready():
             print("❌ 模型載入失敗！")
@@ -80,12 +93,12 @@ def main():
         
         # 批量處理
         if args.batch:
-            process_batch(args.batch, stt, args.output)
+            process_batch(args.batch, stt, args.output, args.batch_size)
             return
         
         # 單個文件處理
         if args.audio_file:
-            process_single_file(args.audio_file, stt, args.output, args.verbose)
+            process_single_file(args.audio_file, stt, args.output, args.verbose, args.long_context)
             return
             
     except KeyboardInterrupt:
@@ -98,7 +111,7 @@ def main():
             traceback.print_exc()
         sys.exit(1)
 
-def process_single_file(audio_file, stt, output_file, verbose=False):
+def process_single_file(audio_file, stt, output_file, verbose=False, long_context=False):
     """處理單個音頻文件"""
     # 檢查文件是否存在
     if not os.path.exists(audio_file):
@@ -111,7 +124,7 @@ def process_single_file(audio_file, stt, output_file, verbose=False):
     print("-" * 50)
     
     # 執行辨識
-    result = stt.transcribe_file(audio_file)
+    result = stt.transcribe_file(audio_file, long_context=long_context)
     
     if result.get('success'):
         transcription = result['transcription']
@@ -136,28 +149,21 @@ def process_single_file(audio_file, stt, output_file, verbose=False):
     else:
         print(f"❌ 辨識失敗: {result.get('error', '未知錯誤')}")
 
-def process_batch(folder_path, stt, output_folder):
+def iter_audio_files(folder_path):
+    """逐個產出目錄中的音頻文件路徑"""
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if file.lower().endswith(SUPPORTED_AUDIO_TUPLE):
+                yield os.path.join(root, file)
+
+def process_batch(folder_path, stt, output_folder, batch_size=8):
     """批量處理目錄中的音頻文件"""
     if not os.path.exists(folder_path):
         print(f"❌ 目錄不存在: {folder_path}")
         return
     
-    # 支持的音頻格式
-    audio_extensions = {'.wav', '.mp3', '.m4a', '.flac', '.ogg', '.m4a'}
-    
-    # 獲取所有音頻文件
-    audio_files = []
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in audio_extensions):
-                audio_files.append(os.path.join(root, file))
-    
-    if not audio_files:
-        print(f"❌ 在目錄 {folder_path} 中沒有找到音頻文件")
-        return
-    
-    print(f"📁 找到 {len(audio_files)} 個音頻文件")
-    print(f"🎵 支持的格式: {', '.join(audio_extensions)}")
+    print(f"📁 掃描目錄: {folder_path}")
+    print(f"🎵 支持的格式: {', '.join(SUPPORTED_AUDIO_TUPLE)}")
     print()
     
     # 創建輸出目錄
@@ -166,22 +172,24 @@ def process_batch(folder_path, stt, output_folder):
         print(f"📂 輸出目錄: {output_folder}")
         print()
     
-    # 處理每個文件
+    # 邊掃描邊辨識，每批完成後立即輸出結果
+    print(f"🚀 批量辨識中 (batch_size={batch_size})...")
+    print()
+    start_time = time.time()
+    
+    # 處理每個文件的結果
+    total_count = 0
     success_count = 0
-    total_time = 0
     
-    for i, audio_file in enumerate(audio_files, 1):
-        print(f"[{i}/{len(audio_files)}] 處理: {os.path.basename(audio_file)}")
-        
-        result = stt.transcribe_file(audio_file)
+    results = stt.iter_transcribe_files(iter_audio_files(folder_path), batch_size=batch_size)
+    for i, (audio_file, result) in enumerate(results, 1):
+        total_count = i
+        print(f"[{i}] 處理: {os.path.basename(audio_file)}")
         
         if result.get('success'):
             success_count += 1
             transcription = result['transcription']
             
-            if 'processing_time' in result:
-                total_time += result['processing_time']
-            
             # 保存結果
             if output_folder:
                 output_file = os.path.join(
@@ -201,16 +209,22 @@ def process_batch(folder_path, stt, output_folder):
         
         print()
     
+    total_time = time.time() - start_time
+    
+    if total_count == 0:
+        print(f"❌ 在目錄 {folder_path} 中沒有找到音頻文件")
+        return
+    
     # 顯示統計信息
     print(f"🎯 批量處理完成！")
     print(f"📊 統計信息:")
-    print(f"   總文件數: {len(audio_files)}")
+    print(f"   總文件數: {total_count}")
     print(f"   成功數量: {success_count}")
-    print(f"   失敗數量: {len(audio_files) - success_count}")
-    print(f"   成功率: {success_count/len(audio_files)*100:.1f}%")
+    print(f"   失敗數量: {total_count - success_count}")
+    print(f"   成功率: {success_count/total_count*100:.1f}%")
     if total_time > 0:
         print(f"   總處理時間: {total_time:.2f} 秒")
-        print(f"   平均處理時間: {total_time/success_count:.2f} 秒")
+        print(f"   平均處理時間: {total_time/total_count:.2f} 秒")
 
 def simple_mode():
     """簡單模式 - 無需參數的交互式使用"""
@@ -220,7 +234,7 @@ def simple_mode():
     # 檢查是否有音頻文件
     audio_files = []
     for file in os.listdir('.'):
-        if file.lower().endswith(('.wav', '.mp3', '.m4a', '.flac', '.ogg')):
+        if file.lower().endswith(SUPPORTED_AUDIO_TUPLE):
             audio_files.append(file)
     
     if audio_files:
@@ -6,44 +6,272 @@
 """
 
 import os
-import tempfile
+import io
 import logging
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
-import torch
-from local_stt import LocalSTT
-import sounddevice as sd
-import soundfile as sf
-import numpy as np
+from werkzeug.exceptions import HTTPException
 import threading
 import queue
 import time
 import socket
+import bisect
+from collections import OrderedDict, deque
+
+try:
+    from blake3 import blake3 as content_hash
+except ImportError:
+    # 未安裝blake3時退回標準庫的blake2b
+    from hashlib import blake2b as content_hash
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# 限制上傳大小
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+# waitress層的請求體上限：略高於MAX_CONTENT_LENGTH，稍微超限的上傳仍由Flask返回JSON 413，
+# 遠超限制的請求在waitress的I/O線程中直接拒絕，不會被完整接收
+SERVER_MAX_BODY_SIZE = app.config['MAX_CONTENT_LENGTH'] + 1024 * 1024
+# 每批最多合併的請求數
+MAX_BATCH_SIZE = 8
+# waitress工作線程數：每個等待批處理結果的上傳佔用一個線程，最多兩批在推理/排隊、一批在湊批，
+# 需留出餘量，突發上傳時/health和頁面請求仍有空閒線程
+SERVER_THREADS = MAX_BATCH_SIZE * 4
 CORS(app)
 
+# 壓縮HTML和JSON響應（優先brotli），未安裝flask-compress時不壓縮
+try:
+    from flask_compress import Compress
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_MIN_SIZE'] = 512
+    Compress(app)
+except ImportError:
+    logger.info("flask-compress 未安裝，響應不壓縮")
+
+# 使用orjson序列化JSON響應（直接輸出UTF-8字節，中文不轉義），未安裝時使用Flask默認實現
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+    
+    class OrjsonProvider(DefaultJSONProvider):
+        """基於orjson的JSON provider"""
+        
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+        
+        def response(self, *args, **kwargs):
+            # 直接使用orjson輸出的字節，省去bytes -> str -> bytes的轉換
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(
+                orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                mimetype=self.mimetype
+            )
+    
+    app.json = OrjsonProvider(app)
+except ImportError:
+    logger.info("orjson 未安裝，使用默認JSON序列化")
+
 # 全局變量
 stt_instance = None
-recording = False
-audio_queue = queue.Queue()
-sample_rate = 16000
+batch_scheduler = None
+# GPU是否可用只在載入模型時檢測一次（載入前為None）
+GPU_AVAILABLE = None
+# torch和LocalSTT在init_stt中才導入，服務可以先啟動
+torch = None
+LocalSTT = None
+# 模型載入完成且批處理調度器已啟動後設置
+STT_READY = threading.Event()
+
+# 本機IP緩存：(查詢時間, IP)
+LOCAL_IP_TTL = 30
+_local_ip_cache = (float('-inf'), None)
 
 def get_local_ip():
-    """獲取本機IP地址"""
+    """獲取本機IP地址（結果緩存30秒，網絡變化後會自動更新）"""
+    global _local_ip_cache
+    now = time.monotonic()
+    cached_at, cached_ip = _local_ip_cache
+    if now - cached_at < LOCAL_IP_TTL:
+        return cached_ip
+    
     try:
-        # 連接到外部地址來獲取本機IP
+        # 連接到外部地址來獲取本機IP（UDP connect不會實際發送數據）
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
-        return ip
     except:
-        return "127.0.0.1"
+        ip = "127.0.0.1"
+    
+    _local_ip_cache = (now, ip)
+    return ip
+
+# 批處理時長分桶的上界（秒），更長的音頻歸入最後一個桶
+DURATION_BUCKETS = (5, 15, 30)
+
+def get_duration_bucket(audio, sample_rate=16000):
+    """返回音頻所屬時長桶的索引"""
+    return bisect.bisect_left(DURATION_BUCKETS, len(audio) / sample_rate)
+
+class TranscriptionCache:
+    """以音頻內容哈希為鍵的LRU辨識結果緩存（線程安全）"""
+    
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def digest(data):
+        """計算音頻字節的內容哈希"""
+        return content_hash(data).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            result = self._items.get(key)
+            if result is not None:
+                self._items.move_to_end(key)
+                return dict(result)
+        return None
+    
+    def put(self, key, result):
+        with self._lock:
+            self._items[key] = dict(result)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+transcription_cache = TranscriptionCache()
+
+class BatchScheduler:
+    """
+    微批處理調度器
+    
+    後台工作線程收集短時間窗口內到達的請求，合併為一批交給模型推理，
+    避免並發上傳逐個佔用GPU。請求按時長分桶，只在同一桶內湊批，
+    短音頻不會和長音頻同批而被拖慢；有請求等待超時時先處理該請求所在的桶，否則處理湊滿的桶。
+    分為兩個線程：特徵線程湊批並在CPU上提取log-mel特徵，推理線程只負責GPU推理。
+    推理線程忙碌時只取出湊滿的桶並提前提取特徵（與當前批的推理重疊），
+    其餘請求繼續等待與之後到達的請求合併，直到推理線程空閒。
+    """
+    
+    def __init__(self, stt, max_batch_size=MAX_BATCH_SIZE, max_wait=0.05, on_ready=None):
+        """
+        Args:
+            stt: LocalSTT實例（以warmup_on_load=False創建，由推理線程預熱）
+            max_batch_size: 每批最多合併的請求數
+            max_wait: 請求為湊批最多等待的時間（秒）
+            on_ready: 推理線程預熱完成後調用的回調
+        """
+        self.stt = stt
+        self.on_ready = on_ready
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._buckets = [deque() for _ in range(len(DURATION_BUCKETS) + 1)]
+        self._cond = threading.Condition()
+        # 已取出但尚未推理完成的批次數（最多一批在推理、一批在排隊），由self._cond保護
+        self._inflight = 0
+        # 已提取特徵、等待推理的批次
+        self._ready = queue.Queue()
+        self._feature_worker = threading.Thread(target=self._prepare_batches, daemon=True)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._feature_worker.start()
+        self._worker.start()
+    
+    def submit(self, audio, timeout=300):
+        """提交16kHz單聲道音頻數組並等待辨識結果"""
+        job = {
+            'audio': audio,
+            'event': threading.Event(),
+            'result': None,
+            'deadline': time.monotonic() + self.max_wait
+        }
+        with self._cond:
+            self._buckets[get_duration_bucket(audio)].append(job)
+            self._cond.notify()
+        
+        if not job['event'].wait(timeout):
+            return {'error': '語音辨識超時'}
+        return job['result']
+    
+    def _collect(self):
+        """
+        取出下一批請求
+        
+        推理線程空閒時，有請求等待超時就取批；推理線程忙碌時不按超時取批，讓請求繼續合併，
+        只有某個桶湊滿一批時才提前取批；已有一批在排隊等待推理時不再取。
+        取批時優先取等待超時最久的請求所在的桶（避免冷門桶中的請求被繁忙的桶餓死），否則取最滿的桶。
+        """
+        with self._cond:
+            while True:
+                pending = [bucket for bucket in self._buckets if bucket]
+                oldest = min(pending, key=lambda bucket: bucket[0]['deadline']) if pending else None
+                remaining = oldest[0]['deadline'] - time.monotonic() if oldest else None
+                expired = remaining is not None and remaining <= 0
+                
+                if self._inflight == 0 and expired:
+                    chosen = oldest
+                    break
+                
+                fullest = max(self._buckets, key=len)
+                if self._inflight < 2 and len(fullest) >= self.max_batch_size:
+                    chosen = oldest if expired else fullest
+                    break
+                
+                # 推理線程忙碌時只等待新請求或推理完成的通知
+                self._cond.wait(remaining if self._inflight == 0 else None)
+            
+            self._inflight += 1
+            return [chosen.popleft() for _ in range(min(len(chosen), self.max_batch_size))]
+    
+    def _prepare_batches(self):
+        """特徵線程：湊批並提取log-mel特徵"""
+        while True:
+            jobs = self._collect()
+            
+            try:
+                features = self.stt.extract_features([job['audio'] for job in jobs])
+            except Exception as e:
+                # 交給推理線程按普通路徑處理
+                logger.warning(f"提前提取特徵失敗: {str(e)}")
+                features = None
+            
+            self._ready.put((jobs, features))
+    
+    def _run(self):
+        """推理線程主循環（整個線程生命週期都處於inference_mode）"""
+        with torch.inference_mode():
+            # CUDA graph按線程保存，必須在本線程預熱，否則首批請求會重新捕獲
+            self.stt.warmup()
+            if self.on_ready is not None:
+                self.on_ready()
+            
+            while True:
+                jobs, features = self._ready.get()
+                
+                try:
+                    results = self.stt.transcribe_arrays(
+                        [job['audio'] for job in jobs],
+                        batch_size=self.max_batch_size,
+                        features=features
+                    )
+                except Exception as e:
+                    logger.error(f"批量語音辨識失敗: {str(e)}")
+                    results = [{'error': f'語音辨識失敗: {str(e)}'} for _ in jobs]
+                
+                for job, result in zip(jobs, results):
+                    job['result'] = result
+                    job['event'].set()
+                
+                # 推理完成，通知特徵線程可以取下一批
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
 
 # HTML模板
 HTML_TEMPLATE = """
@@ -504,6 +732,12 @@ HTML_TEMPLATE = """
                     body: formData
                 });
                 
+                // 遠超上傳限制時服務器返回的413不是JSON
+                if (response.status === 413) {
+                    displayResult({ error: '文件過大，最大支持50MB' }, filename);
+                    return;
+                }
+                
                 const result = await response.json();
                 displayResult(result, filename);
                 
@@ -538,10 +772,21 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# 頁面不含模板變量，啟動時計算一次ETag供瀏覽器緩存驗證
+HTML_ETAG = content_hash(HTML_TEMPLATE.encode('utf-8')).hexdigest()
+
 @app.route('/')
 def index():
-    """主頁面"""
-    return render_template_string(HTML_TEMPLATE)
+    """主頁面（內容未變時返回304）"""
+    # flask-compress會把壓縮響應的ETag改寫為"<hash>:br"、"<hash>:gzip"，比較時去掉算法後綴
+    client_etags = request.if_none_match.as_set(include_weak=True)
+    if any(etag.split(':', 1)[0] == HTML_ETAG for etag in client_etags):
+        response = make_response('', 304)
+    else:
+        response = make_response(HTML_TEMPLATE)
+    response.set_etag(HTML_ETAG)
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
 
 @app.route('/network_info')
 def network_info():
@@ -557,13 +802,16 @@ def health():
     return jsonify({
         'status': 'healthy',
         'local_ip': get_local_ip(),
-        'gpu_available': torch.cuda.is_available(),
-        'model_loaded': stt_instance is not None and stt_instance.is_ready()
+        'gpu_available': GPU_AVAILABLE,
+        'model_loaded': STT_READY.is_set()
     })
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe_audio():
     """語音辨識API端點"""
+    if not STT_READY.is_set():
+        return jsonify({'error': '模型尚未載入'}), 503
+    
     try:
         if 'audio' not in request.files:
             return jsonify({'error': '沒有音頻文件'}), 400
@@ -572,37 +820,54 @@ def transcribe_audio():
         if audio_file.filename == '':
             return jsonify({'error': '沒有選擇文件'}), 400
         
-        # 保存上傳的文件
-        temp_file = tempfile.NamedTemporaryFile(suffix='.wav', delete=False)
-        audio_file.save(temp_file.name)
-        temp_file.close()
+        # 記錄開始時間
+        start_time = time.time()
         
-        try:
-            # 記錄開始時間
-            start_time = time.time()
-            
-            # 執行語音辨識
-            result = stt_instance.transcribe_file(temp_file.name)
-            
-            # 計算處理時間
-            processing_time = time.time() - start_time
-            
-            # 添加處理時間到結果
-            if result.get('success'):
-                result['processing_time'] = round(processing_time, 2)
-                result['filename'] = audio_file.filename
-            
+        # 相同內容的音頻直接返回緩存結果（如重複上傳、前端重試）
+        data = audio_file.stream.read()
+        digest = transcription_cache.digest(data)
+        result = transcription_cache.get(digest)
+        if result is not None:
+            result['processing_time'] = round(time.time() - start_time, 2)
+            result['filename'] = audio_file.filename
+            result['cache_hit'] = True
             return jsonify(result)
-            
-        finally:
-            # 清理臨時文件
-            if os.path.exists(temp_file.name):
-                os.unlink(temp_file.name)
-                
+        
+        # 直接在內存中解碼，保留原始擴展名以便必要時正確識別編碼
+        suffix = os.path.splitext(audio_file.filename)[1].lower() or '.wav'
+        try:
+            audio, _ = stt_instance.preprocess_audio_buffer(io.BytesIO(data), suffix)
+        except Exception as e:
+            logger.error(f"音頻解碼失敗: {str(e)}")
+            return jsonify({'error': f'音頻解碼失敗: {str(e)}'}), 400
+        
+        # 交給批處理調度器，與同時到達的請求合併推理
+        result = batch_scheduler.submit(audio)
+        
+        # 計算處理時間
+        processing_time = time.time() - start_time
+        
+        # 添加處理時間到結果（只緩存成功的結果）
+        if result.get('success'):
+            transcription_cache.put(digest, result)
+            result['processing_time'] = round(processing_time, 2)
+            result['filename'] = audio_file.filename
+            result['cache_hit'] = False
+        
+        return jsonify(result)
+        
+    except HTTPException:
+        # 如上傳過大時的413，交給對應的錯誤處理器返回JSON
+        raise
     except Exception as e:
         logger.error(f"語音辨識失敗: {str(e)}")
         return jsonify({'error': f'語音辨識失敗: {str(e)}'}), 500
 
+@app.errorhandler(413)
+def file_too_large(e):
+    """上傳文件超過大小限制"""
+    return jsonify({'error': '文件過大，最大支持50MB'}), 413
+
 @app.route('/model_info')
 def model_info():
     """獲取模型信息"""
@@ -613,20 +878,62 @@ def model_info():
 
 def init_stt():
     """初始化STT模型"""
-    global stt_instance
+    global stt_instance, batch_scheduler, torch, LocalSTT, GPU_AVAILABLE
     try:
         logger.info("正在初始化STT模型...")
-        stt_instance = LocalSTT()
+        # local_stt需在torch之前導入以設置CUDA內存分配策略
+        from local_stt import LocalSTT
+        import torch
+        GPU_AVAILABLE = torch.cuda.is_available()
+        
+        # 沒有GPU時使用ONNX Runtime int8後端（不可用時自動回退）
+        stt_instance = LocalSTT(
+            backend="transformers" if GPU_AVAILABLE else "onnx", warmup_on_load=False
+        )
         if stt_instance.is_ready():
-            logger.info("STT模型初始化成功！")
+            batch_scheduler = BatchScheduler(stt_instance, on_ready=_on_stt_ready)
+            logger.info("STT模型載入完成，推理線程預熱中...")
         else:
             logger.error("STT模型初始化失敗！")
     except Exception as e:
         logger.error(f"STT模型初始化失敗: {str(e)}")
 
+def _on_stt_ready():
+    """推理線程預熱完成後開始接受請求"""
+    STT_READY.set()
+    logger.info("STT模型初始化成功！")
+
+def init_stt_async():
+    """在後台線程中初始化STT模型，期間/health可用、/transcribe返回503"""
+    thread = threading.Thread(target=init_stt, daemon=True)
+    thread.start()
+    return thread
+
+def run_server(host="0.0.0.0", port=5000, threads=SERVER_THREADS, debug=False):
+    """
+    啟動HTTP服務
+    
+    優先使用多線程的waitress生產服務器；未安裝waitress或開啟調試模式時使用Flask內建服務器。
+    waitress在異步I/O線程中接收完整個請求體後才交給工作線程，
+    手機慢速上傳不會佔用工作線程，工作線程只負責解碼並等待批處理結果。
+    """
+    if not debug:
+        try:
+            from waitress import serve
+        except ImportError:
+            logger.warning("waitress 未安裝，使用Flask內建服務器")
+        else:
+            serve(
+                app, host=host, port=port, threads=threads,
+                max_request_body_size=SERVER_MAX_BODY_SIZE
+            )
+            return
+    
+    app.run(host=host, port=port, debug=debug, threaded=True)
+
 if __name__ == '__main__':
-    # 初始化STT模型
-    init_stt()
+    # 在後台初始化STT模型，服務同時開始監聽
+    init_stt_async()
     
     # 獲取本機IP
     local_ip = get_local_ip()
@@ -641,4 +948,4 @@ if __name__ == '__main__':
     logger.info(f"手機訪問: http://{local_ip}:{port}")
     logger.info(f"健康檢查: http://{local_ip}:{port}/health")
     
-    app.run(host=host, port=port, debug=False)
+    run_server(host=host, port=port)